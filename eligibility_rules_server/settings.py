@@ -127,6 +127,14 @@ CORS_ORIGIN_ALLOW_ALL = True
 # CORS_URLS_REGEX = r'^/rulings/.*$'  # only allow CORS for /api/ routes
 CORS_ALLOW_METHODS = ('GET', 'OPTIONS', 'POST',)  # only allow read-only methods
 
+# Run all of an application's applicants through the rules in one
+# query, rather than one query per applicant
+RULES_BULK_FINDINGS = os.environ.get('RULES_BULK_FINDINGS') == 'true'
+
+# Write rulings out as each applicant is ruled on, rather than building
+# the whole response first; worthwhile for large batches of applicants
+RULES_STREAM_FINDINGS = os.environ.get('RULES_STREAM_FINDINGS') == 'true'
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/2.0/howto/static-files/
 
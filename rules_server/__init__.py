@@ -0,0 +1 @@
+default_app_config = 'rules_server.apps.RulesServerConfig'
@@ -1,5 +1,26 @@
 from django.apps import AppConfig
+from django.db import DatabaseError
 
 
 class RulesServerConfig(AppConfig):
     name = 'rules_server'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+
+        self.preload_rulesets()
+
+    def preload_rulesets(self):
+        """
+        Read every ruleset and compile its syntax schemas up front.
+
+        Keeps that work out of the first requests.  Runs for every
+        management command too, so nothing here may stop them: an
+        invalid schema is only logged, and reported when requested.
+        """
+
+        try:
+            self.get_model('Ruleset').preload()
+        except DatabaseError:
+            # No database yet, or not migrated yet
+            pass
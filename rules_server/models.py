@@ -1,13 +1,43 @@
-from copy import deepcopy
-
-import jsonschema
+import json
+import logging
+from collections import defaultdict
+from contextlib import ExitStack
+from functools import lru_cache
+
+import fastjsonschema
+from django.conf import settings
 from django.contrib.postgres.fields.jsonb import JSONField
 from django.core import exceptions
-from django.db import DataError, connection, models
+from django.db import DataError, connection, models, transaction
+from django.db.models import Prefetch
+from django.utils.functional import cached_property
 from prettytable import from_db_cursor
 from rest_framework import exceptions
 
-from .utils import DefaultValidatingDraft4Validator, values_from_json
+from .tree import LoadedNode, LoadedRule
+from .utils import (column_types, compile_validator, execute_prepared,
+                    relationalize, sql, values_from_json)
+
+logger = logging.getLogger(__name__)
+
+# Compiled validators by SyntaxSchema id; see rules_server.signals
+COMPILED_VALIDATORS = {}
+
+# Rulesets read by Ruleset.load, by (program, entity); see rules_server.signals
+LOADED_RULESETS = {}
+
+
+def _savepoint():
+    """
+    Savepoint to roll a failed query back to, inside a transaction
+
+    Otherwise the transaction is aborted and Ruleset._rules_error can't
+    run its queries; in autocommit mode there is nothing to roll back.
+    """
+
+    if connection.in_atomic_block:
+        return transaction.atomic()
+    return ExitStack()
 
 
 class Ruleset(models.Model):
@@ -19,6 +49,97 @@ class Ruleset(models.Model):
     class Meta:
         unique_together = (("program", "entity"), )
 
+    @classmethod
+    def load(cls, program, entity):
+        """
+        Ruleset with its syntax schemas and node tree, read once per process.
+
+        Raises Ruleset.DoesNotExist if there is no such ruleset.
+        """
+
+        try:
+            return LOADED_RULESETS[(program, entity)]
+        except KeyError:
+            ruleset = cls.objects.prefetch_related('syntaxschema_set').get(
+                program=program, entity=entity)
+            return ruleset._preload()
+
+    @classmethod
+    def preload(cls):
+        """
+        Read every ruleset into LOADED_RULESETS
+
+        A ruleset whose syntax schema won't compile is logged and left
+        out, for `load` to report when that ruleset is requested.
+        """
+
+        for ruleset in cls.objects.prefetch_related('syntaxschema_set'):
+            try:
+                ruleset._preload()
+            except fastjsonschema.JsonSchemaDefinitionException as exc:
+                logger.warning("Syntax schema for %s/%s does not compile: %s",
+                               ruleset.program, ruleset.entity, exc)
+
+    def _preload(self):
+        for syntax_schema in self.syntaxschema_set.all():
+            syntax_schema.validator
+            syntax_schema.data_types
+        self.schema
+        self.findings_sql_template
+        LOADED_RULESETS[(self.program, self.entity)] = self
+        return self
+
+    @cached_property
+    def root_nodes(self):
+        """
+        Top-level nodes, read with all their descendants and rules.
+
+        Nodes and rules are read in id order, so explanations are
+        listed in the order the rules were written.
+        """
+
+        rules = Prefetch('rule_set', queryset=Rule.objects.order_by('id'))
+        levels = []
+        level = self.node_set.filter(parent__isnull=True)
+        while True:
+            level = list(level.order_by('id').prefetch_related(rules))
+            if not level:
+                break
+            levels.append(level)
+            level = Node.objects.filter(parent__in=level)
+
+        # deepest level first, so each node's children are complete
+        children = defaultdict(list)
+        for level in reversed(levels):
+            for node in level:
+                children[node.parent_id].append(
+                    LoadedNode(node, children[node.id]))
+        return children[None]
+
+    @cached_property
+    def nodes(self):
+        """Every node in the tree, parents before children"""
+
+        result = []
+        level = self.root_nodes
+        while level:
+            result.extend(level)
+            level = [child for node in level for child in node.children]
+        return result
+
+    @cached_property
+    def rules(self):
+        """Every rule in the node tree"""
+
+        return [rule for node in self.nodes for rule in node.rules]
+
+    @cached_property
+    def findings_sql_template(self):
+        """Query for `findings`, lacking only the source clauses"""
+
+        return '\nunion all\n'.join(
+            rule.findings_sql_template for rule in self.rules)
+
     def validate(self, applications):
         """
         Validate payload against this ruleset's syntax schemas.
@@ -29,28 +150,56 @@ class Ruleset(models.Model):
         """
 
         for syntax_schema in self.syntaxschema_set.all():
+            validator = syntax_schema.validator
             try:
-                DefaultValidatingDraft4Validator(
-                    syntax_schema.code).validate(applications)
-            except jsonschema.ValidationError as valerr:
+                applications = validator(applications)
+            except fastjsonschema.JsonSchemaException as valerr:
                 raise exceptions.ParseError(str(valerr))
         return applications
 
-    @property
+    @cached_property
     def schema(self):
-        return self.syntaxschema_set.first()
+        """First syntax schema, taken from the prefetched schemas if any"""
+
+        syntax_schemas = sorted(self.syntaxschema_set.all(),
+                                key=lambda syntax_schema: syntax_schema.pk)
+        return syntax_schemas[0] if syntax_schemas else None
 
     def flattened(self, payload):
-        applicants = payload.pop('applicants')
-        for applicant in applicants:
-            applicant_info = deepcopy(payload)
-            applicant_info.update(applicant)
-            yield applicant_info
+        """
+        Yields each applicant's data merged with its application's data.
 
-    def null_source_sql(self, raw):
-        for (key, val) in self.null_sources.items():
-            if key not in raw:
-                yield " %s as ( select * from %s ) " % (key, val)
+        The merge is shallow; nothing downstream modifies the result.
+        """
+
+        application_info = {
+            key: val
+            for (key, val) in payload.items() if key != 'applicants'
+        }
+        for applicant in payload['applicants']:
+            yield {**application_info, **applicant}
+
+    def null_source_sql(self, names):
+        for key in names:
+            yield " %s as ( select * from %s ) " % (key,
+                                                    self.null_sources[key])
+
+    @lru_cache(maxsize=1024)
+    def source_clause(self, table_types, null_source_names):
+        """
+        WITH clause for applicant data of one shape.
+
+        `table_types` pairs each pseudo-table's name with its column
+        types; `null_source_names` are the null sources the data lacks.
+        Cleared by rules_server.signals.
+        """
+
+        source_sql = [
+            sql(table_name, data_types, schema=self.schema)
+            for (table_name, data_types) in table_types
+        ]
+        source_sql.extend(self.null_source_sql(null_source_names))
+        return 'WITH ' + ',\n'.join(source_sql)
 
     def source_sql_statements(self, raw):
         with connection.cursor() as cursor:
@@ -58,54 +207,158 @@ class Ruleset(models.Model):
                     raw, self.schema):
                 table_name = source_sql.split()[0]
                 source_sql = "with " + source_sql + " select * from " + table_name
-                source_sql = source_sql.replace("%s", "'%s'") % source_data
-                yield (source_sql)
-                cursor.execute(source_sql)
+                yield cursor.mogrify(source_sql, (source_data, )).decode()
+                cursor.execute(source_sql, (source_data, ))
                 yield str(from_db_cursor(cursor))
 
     def values_from_json(self, raw):
+        """
+        Source clause and parameters for applicant data `raw`.
 
-        (source_sql,
-         source_data) = zip(*(values_from_json(raw, schema=self.schema)))
-        source_sql += tuple(self.null_source_sql(raw))
-        source_clause = 'WITH ' + ',\n'.join(source_sql)
-        return (source_clause, source_data)
+        Only the parameters depend on the values in `raw`; the clause
+        is shared by all data with the same tables and column types.
+        """
+
+        (table_types, source_data) = ([], [])
+        for (table_name, data) in relationalize(raw, 'applicant').items():
+            table_types.append((table_name, tuple(column_types(data).items())))
+            source_data.append(json.dumps(data))
+        null_source_names = tuple(
+            key for key in self.null_sources if key not in raw)
+        source_clause = self.source_clause(
+            tuple(table_types), null_source_names)
+        return (source_clause, tuple(source_data))
+
+    def findings(self, source_clause, source_data):
+        """
+        Runs every rule against one applicant's data, in a single query.
+
+        Returns each rule's finding, by rule id.
+        """
+
+        if not self.rules:
+            return {}
+        sql = self.findings_sql_template % (
+            (source_clause, ) * len(self.rules))
+        with connection.cursor() as cursor:
+            try:
+                with _savepoint():
+                    execute_prepared(
+                        cursor, sql, source_data, repeat=len(self.rules))
+            except Exception as exc:
+                raise self._rules_error(exc, sql,
+                                        [(source_clause, source_data)])
+            rows = cursor.fetchall()
+        return {row[0]: LoadedRule.finding(row[1:]) for row in rows}
+
+    def bulk_findings(self, sources):
+        """
+        Runs every rule against several applicants' data, in one query.
+
+        `sources` holds a (source clause, source data) pair per applicant;
+        returns a list of `findings` results in the same order.
+        """
+
+        if not sources:
+            return []
+        if not self.rules:
+            return [{} for source in sources]
+        (sql, params) = ([], {})
+        for (i, (source_clause, source_data)) in enumerate(sources):
+            # Each applicant's data is sent once, as named parameters
+            # shared by all its rules; %% escapes are doubled to survive
+            names = tuple('source_%d_%d' % (i, j)
+                          for j in range(len(source_data)))
+            applicant_sql = self.findings_sql_template % (
+                (source_clause, ) * len(self.rules))
+            applicant_sql = applicant_sql.replace('%%', '%%%%') % tuple(
+                '%%(%s)s' % name for name in names * len(self.rules))
+            # concatenated, not %-formatted, to leave %(...)s for execute
+            sql.append("select %d, applicant_findings.* from (" % i +
+                       applicant_sql + ") applicant_findings")
+            params.update(zip(names, source_data))
+        sql = '\nunion all\n'.join(sql)
+        with connection.cursor() as cursor:
+            try:
+                with _savepoint():
+                    cursor.execute(sql, params)
+            except Exception as exc:
+                raise self._rules_error(exc, sql, sources)
+            rows = cursor.fetchall()
+        result = [{} for source in sources]
+        for row in rows:
+            result[row[0]][row[1]] = LoadedRule.finding(row[2:])
+        return result
+
+    def _rules_error(self, exc, sql, sources):
+        """
+        DataError for `exc`, raised by the combined findings query `sql`
+
+        Reruns the rules one by one against `sources`' (source clause,
+        source data) pairs, so the error can name the rule that failed.
+        """
+
+        for rule in self.rules:
+            for (source_clause, source_data) in sources:
+                rule_sql = rule.sql_template % source_clause
+                try:
+                    with transaction.atomic(), connection.cursor() as cursor:
+                        cursor.execute(rule_sql, source_data)
+                except Exception as rule_exc:
+                    msg = ("Error executing rule %s\n" % rule.name +
+                           str(rule_exc) + '\n\n in sql:\n\n' + rule_sql)
+                    return DataError(msg)
+        msg = ("Error executing rules for %s/%s\n" %
+               (self.program, self.entity) + str(exc) + '\n\n in sql:\n\n' +
+               sql)
+        return DataError(msg)
 
     def calc(self, application):
+        """Yields (applicant id, result) for each applicant in `application`"""
+
+        applicants = list(self.flattened(application))
+        sources = [
+            self.values_from_json(applicant) for applicant in applicants
+        ]
+        if settings.RULES_BULK_FINDINGS:
+            all_findings = self.bulk_findings(sources)
+        else:
+            all_findings = (self.findings(source_clause, source_data)
+                            for (source_clause, source_data) in sources)
 
-        overall_result = {}
-        for applicant in self.flattened(application):
+        for (applicant, findings) in zip(applicants, all_findings):
             eligibility = True
             result = {'requirements': {}}
-            (source_clause, source_data) = self.values_from_json(applicant)
-            for node in self.node_set.filter(parent__isnull=True):
-                node_result = node.calc(source_clause, source_data)
+            # children first, so each node can combine its children's results
+            node_results = {}
+            for node in reversed(self.nodes):
+                node_results[node.id] = node.calc(findings, node_results)
+            for node in self.root_nodes:
+                node_result = node_results[node.id]
                 result['requirements'][node.name] = node_result
                 if node.name != 'categories':
                     eligibility &= node_result['eligible']
             result['eligible'] = eligibility
-            overall_result[int(applicant['id'])] = result
 
             categories = result['requirements'].pop('categories', {})
+            category_findings = categories.get('subfindings', {})
             category_names = [
-                key
-                for (key, val) in categories.get('subfindings', {}).items()
+                key for (key, val) in category_findings.items()
                 if val['eligible']
             ]
             result['categories'] = {
                 'applicable': category_names,
-                'findings': categories.get('subfindings', {})
+                'findings': category_findings
             }
 
-            overall_result[int(applicant['id'])] = result
-        return overall_result
+            yield (int(applicant['id']), result)
 
     def sql(self, application):
 
         for applicant in self.flattened(application):
             (source_clause, source_data) = self.values_from_json(applicant)
-            for node in self.node_set.all():
-                yield from node.sql(source_clause, source_data)
+            for rule in self.rules:
+                yield rule.sql(source_clause, source_data)
 
 
 class Node(models.Model):
@@ -121,45 +374,6 @@ class Node(models.Model):
     def get_ruleset(self):
         return self.ruleset or self.parent.get_ruleset
 
-    def sql(self, source_clause, source_data):
-        for rule in self.rule_set.all():
-            yield rule.sql(source_clause, source_data)
-
-    def calc(self, source_clause, source_data):
-
-        if self.requires_all:
-            eligibility = True
-        else:
-            eligibility = False
-
-        node_result = {'limitation': [], 'explanation': [], 'subfindings': {}}
-
-        for child_node in self.node_set.all():
-            child_node_result = child_node.calc(source_clause, source_data)
-            if self.requires_all:
-                eligibility &= child_node_result['eligible']
-            else:
-                eligibility |= child_node_result['eligible']
-            node_result['explanation'].append(child_node_result['explanation'])
-            if child_node_result['eligible'] and child_node_result['limitation']:
-                node_result['limitation'].append(
-                    child_node_result['limitation'])
-            node_result['subfindings'][child_node.name] = child_node_result
-
-        for rule in self.rule_set.all():
-            rule_result = rule.calc(source_clause, source_data)
-            node_result['explanation'].append(rule_result['explanation'])
-            if self.requires_all:
-                eligibility &= rule_result['eligible']
-            else:
-                eligibility |= rule_result['eligible']
-            if rule_result['eligible'] and rule_result['limitation']:
-                node_result['limitation'].append(rule_result['limitation'])
-            node_result['subfindings'][rule.name] = rule_result
-
-        node_result['eligible'] = eligibility
-        return node_result
-
 
 class Rule(models.Model):
     name = models.TextField(null=False, blank=False)
@@ -173,61 +387,36 @@ class Rule(models.Model):
     def ruleset(self):
         return self.node.get_ruleset
 
-    _SQL = """with source as (%s %s)
-              select (source.result).eligible,
-                     (source.result).explanation,
-                     ((source.result).limitation).end_date,
-                     ((source.result).limitation).normal,
-                     ((source.result).limitation).description,
-                     ((source.result).limitation).explanation AS limitation_explanation
-              from source"""
-
-    def calc(self, source_clause, source_data):
-
-        with connection.cursor() as cursor:
-            sql = self._SQL % (source_clause, self.code)
-            try:
-                cursor.execute(sql, tuple(source_data))
-            except Exception as exc:
-                msg = ("Error executing rule %s\n" % self.name + str(exc) +
-                       '\n\n in sql:\n\n' + sql)
-                raise DataError(msg)
-            findings = cursor.fetchone()
-        limitation = dict(
-            zip(('end_date', 'normal', 'description', 'explanation'),
-                findings[2:]))
-        if (not limitation['end_date']) and (not limitation['description']):
-            limitation = None
-        return {
-            'eligible': findings[0],
-            'explanation': findings[1],
-            'limitation': limitation
-        }
-
-    def sql(self, source_clause, source_data):
-        result = self._SQL % (source_clause, self.code)
-        result = result.replace("%s", "'%s'")
-        return result % source_data
-
 
 class SyntaxSchema(models.Model):
     ruleset = models.ForeignKey(Ruleset, on_delete=models.CASCADE)
     type = models.TextField(null=False, blank=False, default='jsonschema')
     code = JSONField(null=False, blank=False)
 
-    def walk(self, node=None):
-        """Yields all the dictionaries in a nested structure."""
+    @property
+    def validator(self):
+        """Validating function compiled from `code`, built once per process"""
 
-        node = node or self.code
+        try:
+            return COMPILED_VALIDATORS[self.pk]
+        except KeyError:
+            validator = compile_validator(self.code)
+            COMPILED_VALIDATORS[self.pk] = validator
+            return validator
 
-        if isinstance(node, list):
-            for itm in node:
-                yield from self.walk(itm)
-        else:
-            yield node
-            for (key, val) in node.items():
-                if isinstance(val, dict):
-                    yield from self.walk(val)
+    def walk(self, node=None):
+        """Yields all the dictionaries in a nested structure, depth-first."""
+
+        stack = [node or self.code]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, list):
+                stack.extend(reversed(node))
+            else:
+                yield node
+                stack.extend(
+                    reversed([val for val in node.values()
+                              if isinstance(val, dict)]))
 
     _JSONSCHEMA_TO_PG_TYPES = {
         'integer': 'integer',
@@ -252,13 +441,14 @@ class SyntaxSchema(models.Model):
                     data_type = data_type[0]
             return self._JSONSCHEMA_TO_PG_TYPES.get(data_type)
 
+    @cached_property
     def data_types(self):
         result = {}
         for node in self.walk():
             for (col_name, col_data) in node.get('properties', {}).items():
                 col_type_from_schema = self._col_data_type(col_data)
                 if col_type_from_schema:
-                    result[col_name] = self._col_data_type(col_data)
+                    result[col_name] = col_type_from_schema
         return result
 
     # todo: this should be one-to-one, or sorted so that the
@@ -10,9 +10,6 @@ class RuleSerializer(serializers.ModelSerializer):
 
 
 class RulesetSerializer(serializers.ModelSerializer):
-
-    rule_set = RuleSerializer(many=True, read_only=True)
-
     class Meta:
         model = Ruleset
-        fields = ('id', 'program', 'entity', 'record_spec', 'rule_set')
+        fields = ('id', 'program', 'entity')
@@ -0,0 +1,33 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import (COMPILED_VALIDATORS, LOADED_RULESETS, Node, Rule,
+                     Ruleset, SyntaxSchema)
+
+
+@receiver(post_save, sender=SyntaxSchema)
+@receiver(post_delete, sender=SyntaxSchema)
+def forget_compiled_schema(sender, instance, **kwargs):
+    COMPILED_VALIDATORS.pop(instance.pk, None)
+    instance.__dict__.pop('data_types', None)  # cached_property
+
+
+@receiver(post_save, sender=Ruleset)
+@receiver(post_delete, sender=Ruleset)
+@receiver(post_save, sender=Node)
+@receiver(post_delete, sender=Node)
+@receiver(post_save, sender=Rule)
+@receiver(post_delete, sender=Rule)
+@receiver(post_save, sender=SyntaxSchema)
+@receiver(post_delete, sender=SyntaxSchema)
+def forget_loaded_rulesets(sender, instance, **kwargs):
+    # A rule or node can't cheaply be traced back to its ruleset
+    LOADED_RULESETS.clear()
+    Ruleset.source_clause.cache_clear()
+
+
+@receiver(connection_created)
+def forget_prepared_statements(sender, connection, **kwargs):
+    # Prepared statements die with their connection; see execute_prepared
+    connection.prepared_statements = {}
@@ -5,10 +5,14 @@ from os.path import join
 import hypothesis.strategies as st
 import pytest
 from django.core.management import call_command
+from django.db import DataError, connection
 from hypothesis import given, settings
 from rest_framework import status
 from rest_framework.test import APIClient
 
+from rules_server import utils
+from rules_server.models import Rule
+
 client = APIClient()
 
 with open(join('examples', 'wic-federal0.json')) as infile:
@@ -93,3 +97,122 @@ def test_sql_endpoint():
     response = client.get(url)
     assert response.status_code == status.HTTP_200_OK
     assert 'JSON_TO_RECORDSET' in response.data
+
+
+@pytest.mark.django_db
+def test_sql_endpoint_escapes_payload():
+    """Payload values with quotes don't break the SQL endpoint's queries"""
+
+    url = '/rulings/wic/federal/sql/'
+    payload = deepcopy(payload0)
+    payload[0]['applicants'][0]['adjunct_income_eligibility'][0][
+        'program'] = "women's health"
+    response = client.post(url, payload, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    assert "women''s health" in response.data
+
+
+@pytest.mark.django_db
+def test_rules_endpoint():
+    """Verify that /program/entity/rules/ endpoint lists formatted rules"""
+
+    url = '/rulings/wic/federal/rules/'
+    response = client.get(url)
+    assert response.status_code == status.HTTP_200_OK
+    data = response.json()
+    assert data['program'] == 'wic'
+    assert data['sql']
+    assert 'SELECT' in data['sql'][0]
+
+
+@pytest.mark.django_db
+def test_bulk_findings_match(settings):
+    """Findings are the same whether applicants are queried together or not"""
+
+    url = '/rulings/wic/federal/'
+    # including an application with no applicants at all
+    payload = payload0 + [{'application_id': 3, 'applicants': []}]
+    settings.RULES_BULK_FINDINGS = False
+    expected = client.post(url, payload, format='json').json()
+    assert expected['findings']['3'] == {}
+    settings.RULES_BULK_FINDINGS = True
+    response = client.post(url, payload, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == expected
+
+
+@pytest.mark.django_db
+def test_streamed_findings_match(settings):
+    """Streamed rulings are the same JSON as the buffered response"""
+
+    url = '/rulings/wic/federal/'
+    settings.RULES_STREAM_FINDINGS = False
+    expected = client.post(url, payload0, format='json').json()
+    settings.RULES_STREAM_FINDINGS = True
+    response = client.post(url, payload0, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    assert response.streaming
+    assert json.loads(b''.join(response.streaming_content)) == expected
+
+
+@pytest.mark.django_db
+def test_rule_error_names_rule():
+    """A broken rule is named in the error, not just its ruleset"""
+
+    # the sample ruleset's 'employed' rule has a stray "1G" in its code
+    with pytest.raises(DataError, match='Error executing rule employed'):
+        client.post('/rulings/sample/sample/', format='json')
+
+
+@pytest.mark.django_db
+def test_streamed_rule_error_fails_request(settings):
+    """A broken rule fails the request before any of it is streamed"""
+
+    settings.RULES_STREAM_FINDINGS = True
+    with pytest.raises(DataError, match='Error executing rule employed'):
+        client.post('/rulings/sample/sample/', format='json')
+
+
+@pytest.mark.django_db
+def test_saved_rule_changes_next_ruling():
+    """Rulesets are read once, but saving a rule replaces the loaded copy"""
+
+    url = '/rulings/wic/federal/'
+    assert b'Rule rewritten' not in client.post(
+        url, payload0, format='json').content
+    rule = Rule.objects.filter(node__ruleset__program='wic',
+                               node__ruleset__entity='federal').first()
+    rule.code = "select ROW(true, NULL, 'Rule rewritten')::finding AS result"
+    rule.save()
+    response = client.post(url, payload0, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    assert b'Rule rewritten' in response.content
+
+
+@pytest.mark.django_db
+def test_findings_without_prepared_statements(monkeypatch, settings):
+    """Past MAX_PREPARED_STATEMENTS, findings queries run unprepared"""
+
+    url = '/rulings/wic/federal/'
+    settings.RULES_BULK_FINDINGS = False
+    expected = client.post(url, payload0, format='json').json()
+    monkeypatch.setattr(utils, 'MAX_PREPARED_STATEMENTS', 0)
+    monkeypatch.setattr(connection, 'prepared_statements', {})
+    response = client.post(url, payload0, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == expected
+    assert connection.prepared_statements == {}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_prepared_statements_survive_reconnect(settings):
+    """A new connection prepares its statements afresh"""
+
+    url = '/rulings/wic/federal/'
+    settings.RULES_BULK_FINDINGS = False
+    expected = client.post(url, payload0, format='json').json()
+    assert connection.prepared_statements
+    connection.close()
+    response = client.post(url, payload0, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == expected
@@ -1,7 +1,8 @@
 import pytest
+from fastjsonschema import JsonSchemaDefinitionException
 from rest_framework import exceptions
 
-from rules_server.models import Ruleset, SyntaxSchema
+from rules_server.models import LOADED_RULESETS, Ruleset, SyntaxSchema
 
 
 @pytest.fixture(autouse=True)
@@ -53,3 +54,26 @@ def test_invalid_syntax_fails():
     rs = Ruleset.objects.get(program='syntactic', entity='syntactic')
     with pytest.raises(exceptions.ParseError):
         rs.validate(payload1)
+
+
+@pytest.mark.django_db
+def test_data_types_follow_schema_changes():
+
+    ss = Ruleset.objects.get(
+        program='syntactic', entity='syntactic').syntaxschema_set.first()
+    assert ss.data_types == {'id': 'integer', 'foo': 'integer'}
+
+    ss.code['items']['properties']['foo'] = {'type': ['string', 'null']}
+    ss.save()
+    assert ss.data_types == {'id': 'integer', 'foo': 'text'}
+
+
+@pytest.mark.django_db
+def test_preload_skips_invalid_schema():
+
+    rs = Ruleset.objects.get(program='syntactic', entity='syntactic')
+    SyntaxSchema(ruleset=rs, code={'type': 'nonsense'}).save()
+    Ruleset.preload()
+    assert ('syntactic', 'syntactic') not in LOADED_RULESETS
+    with pytest.raises(JsonSchemaDefinitionException):
+        Ruleset.load('syntactic', 'syntactic')
@@ -0,0 +1,118 @@
+"""
+Plain in-memory copies of a ruleset's nodes and rules.
+
+Rulesets change rarely, so `Ruleset.root_nodes` reads the node/rule
+tree from the database once; evaluating an applicant then walks these
+objects instead of issuing ORM queries at every level.  The rules'
+SQL all runs in one query, `Ruleset.findings`.
+"""
+
+import sqlparse
+from django.db import connection
+from django.utils.functional import cached_property
+
+
+class LoadedRule:
+    def __init__(self, rule):
+        self.id = rule.id
+        self.name = rule.name
+        self.code = rule.code
+        # Everything but the source clause, formatted once; `code`'s own
+        # %% escapes are doubled so they survive that last formatting
+        self.sql_template = self._SQL % ('%s',
+                                         (self.code or '').replace('%', '%%'))
+        self.findings_sql_template = self._FINDINGS_SQL % (self.id,
+                                                           self.sql_template)
+
+    _SQL = """with source as (%s %s)
+              select (source.result).eligible,
+                     (source.result).explanation,
+                     ((source.result).limitation).end_date,
+                     ((source.result).limitation).normal,
+                     ((source.result).limitation).description,
+                     ((source.result).limitation).explanation AS limitation_explanation
+              from source"""
+
+    # One rule's part of Ruleset.findings' query; fetchone() used to
+    # take only the first row of a rule's results, hence the limit
+    _FINDINGS_SQL = """(select %d, findings.* from (%s) findings limit 1)"""
+
+    @staticmethod
+    def finding(row):
+        """Finding from one row of `_SQL` results"""
+
+        limitation = dict(
+            zip(('end_date', 'normal', 'description', 'explanation'),
+                row[2:]))
+        if (not limitation['end_date']) and (not limitation['description']):
+            limitation = None
+        return {
+            'eligible': row[0],
+            'explanation': row[1],
+            'limitation': limitation
+        }
+
+    @cached_property
+    def formatted_code(self):
+        """`code`, pretty-printed; sqlparse is too slow to run per request"""
+
+        return sqlparse.format(
+            self.code or '', reindent=True, keyword_case='upper')
+
+    def sql(self, source_clause, source_data):
+        """This rule's complete SQL for one applicant, for display"""
+
+        with connection.cursor() as cursor:
+            return cursor.mogrify(self.sql_template % source_clause,
+                                  source_data).decode()
+
+
+class LoadedNode:
+    def __init__(self, node, children):
+        self.id = node.id
+        self.name = node.name
+        self.requires_all = node.requires_all
+        self.children = children
+        self.rules = [LoadedRule(rule) for rule in node.rule_set.all()]
+
+    def calc(self, findings, node_results):
+        """
+        Combines results into this node's result.
+
+        `findings` holds rule findings by rule id, and `node_results`
+        the results already calculated for child nodes, by node id.
+        """
+
+        eligibility = self.requires_all
+        limitation = []
+        explanation = []
+        subfindings = {}
+
+        for child_node in self.children:
+            child_node_result = node_results[child_node.id]
+            if self.requires_all:
+                eligibility &= child_node_result['eligible']
+            else:
+                eligibility |= child_node_result['eligible']
+            explanation.append(child_node_result['explanation'])
+            if child_node_result['eligible'] and child_node_result['limitation']:
+                limitation.append(child_node_result['limitation'])
+            subfindings[child_node.name] = child_node_result
+
+        for rule in self.rules:
+            rule_result = findings[rule.id]
+            explanation.append(rule_result['explanation'])
+            if self.requires_all:
+                eligibility &= rule_result['eligible']
+            else:
+                eligibility |= rule_result['eligible']
+            if rule_result['eligible'] and rule_result['limitation']:
+                limitation.append(rule_result['limitation'])
+            subfindings[rule.name] = rule_result
+
+        return {
+            'limitation': limitation,
+            'explanation': explanation,
+            'subfindings': subfindings,
+            'eligible': eligibility
+        }
@@ -1,9 +1,11 @@
 import json
 from collections import defaultdict
+from copy import deepcopy
 from datetime import date
 
+import fastjsonschema
+import orjson
 from django.utils.dateparse import parse_date
-from jsonschema import Draft4Validator, validators
 
 
 def relationalize(target,
@@ -136,21 +138,21 @@ def update_only_existing_keys(dict1, dict2):
     return dict1
 
 
-def record_type(data, schema):
+def record_type(data_types, schema):
     """
-    Generates PostgreSQL record type SQL
+    Generates PostgreSQL record type SQL from `column_types` results
     """
 
-    data_types = column_types(data)
+    data_types = dict(data_types)
     if schema:
-        data_types = update_only_existing_keys(data_types, schema.data_types())
+        data_types = update_only_existing_keys(data_types, schema.data_types)
     return ', '.join(
         '%s %s' % (key, dtype) for (key, dtype) in data_types.items())
 
 
-def sql(name, data, schema=None):
+def sql(name, data_types, schema=None):
 
-    types = record_type(data=data, schema=schema)
+    types = record_type(data_types=data_types, schema=schema)
 
     return """%s AS
         (SELECT * FROM JSON_TO_RECORDSET(%%s) AS x(%s))""" % (name, types)
@@ -159,33 +161,85 @@ def sql(name, data, schema=None):
 def values_from_json(raw, schema=None):
     relationalized = relationalize(raw, 'applicant')
     for (table_name, data) in relationalized.items():
-        yield (sql(table_name, data, schema=schema), json.dumps(data))
+        yield (sql(table_name, column_types(data), schema=schema),
+               json.dumps(data))
 
 
-def extend_with_default(validator_class):
-    validate_properties = validator_class.VALIDATORS["properties"]
+# Per database connection; beyond this, statements are executed unprepared
+MAX_PREPARED_STATEMENTS = 100
 
-    def set_defaults(validator, properties, instance, schema):
 
-        for (property, subschema) in properties.items():
-            if "default" in subschema:
-                instance.setdefault(property, subschema["default"])
+def execute_prepared(cursor, sql, params, repeat=1):
+    """
+    Executes `sql` as a server-side prepared statement.
+
+    `sql` takes `params` `repeat` times over, and is prepared once per
+    database connection, so later executions skip parsing it; PostgreSQL
+    may also reuse a generic plan for them, after its first few custom
+    plans.
+    `cursor.db.prepared_statements` is reset by rules_server.signals
+    for each new connection.
+    """
+
+    statements = cursor.db.prepared_statements
+    name = statements.get(sql)
+    if name is None:
+        if len(statements) >= MAX_PREPARED_STATEMENTS:
+            return cursor.execute(sql, params * repeat)
+        name = 'rules_server_%d' % len(statements)
+        placeholders = tuple('$%d' % (i + 1) for i in range(len(params)))
+        cursor.execute('PREPARE %s AS %s' % (name,
+                                             sql % (placeholders * repeat)))
+        statements[sql] = name
+    return cursor.execute(
+        'EXECUTE %s(%s)' % (name, ', '.join(['%s'] * len(params))), params)
+
+
+def _any_value(value):
+    return True
+
+
+# The jsonschema validator this replaced never checked ``format``, and
+# payloads send "date-time" fields as plain YYYY-MM-DD dates
+UNCHECKED_FORMATS = {
+    fmt: _any_value
+    for fmt in ('date', 'date-time', 'email', 'hostname', 'idn-email',
+                'idn-hostname', 'ipv4', 'ipv6', 'iri', 'iri-reference',
+                'json-pointer', 'regex', 'relative-json-pointer', 'time',
+                'uri', 'uri-reference', 'uri-template')
+}
 
-        for error in validate_properties(
-                validator,
-                properties,
-                instance,
-                schema,
-        ):
-            yield error
 
-    return validators.extend(
-        validator_class,
-        {"properties": set_defaults},
-    )
+def compile_validator(schema):
+    """
+    Compiles JSON schema `schema` into a validating function
+
+    The function fills in default values from the schema and returns
+    the validated data.
+    """
+
+    return fastjsonschema.compile(
+        schema, formats=UNCHECKED_FORMATS, use_default=True)
 
 
-DefaultValidatingDraft4Validator = extend_with_default(Draft4Validator)
+def fast_copy(data):
+    """
+    Independent copy of JSON-shaped `data`
+
+    Round-trips through orjson, which is far quicker than deepcopy;
+    falls back to deepcopy for anything orjson cannot serialize.
+
+    >>> original = {'applicants': [{'id': 1}]}
+    >>> copied = fast_copy(original)
+    >>> copied == original, copied['applicants'] is original['applicants']
+    (True, False)
+    """
+
+    try:
+        return orjson.loads(orjson.dumps(data))
+    except TypeError:
+        return deepcopy(data)
+
 
 if __name__ == "__main__":
     import doctest
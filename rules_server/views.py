@@ -1,4 +1,8 @@
-import sqlparse
+from itertools import chain, islice
+
+import orjson
+from django.conf import settings
+from django.http import StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework import exceptions
 from rest_framework.renderers import BaseRenderer
@@ -7,13 +11,14 @@ from rest_framework.views import APIView
 
 from .models import Ruleset
 from .serializers import RulesetSerializer
+from .utils import fast_copy
 
 
 class RulesetFinderMixin:
     def get_ruleset(self, program, entity):
 
         try:
-            ruleset = Ruleset.objects.get(program=program, entity=entity)
+            ruleset = Ruleset.load(program=program, entity=entity)
         except Ruleset.DoesNotExist:
             detail = "Ruleset for program '{}', entity '{}'" \
                      "has not been defined".format(program, entity)
@@ -66,12 +71,19 @@ class RulingsView(RulesetFinderMixin, APIView):
     def post(self, request, program, entity, format=None):
 
         ruleset = self.get_ruleset(program=program, entity=entity)
-        applications = ruleset.validate(request.data or ruleset.sample_input)
+        applications = ruleset.validate(request.data
+                                        or fast_copy(ruleset.sample_input))
+
+        if settings.RULES_STREAM_FINDINGS:
+            return StreamingHttpResponse(
+                self.stream(program, entity,
+                            self.rulings(ruleset, applications)),
+                content_type='application/json')
 
         results = {}
         for application in applications:
-            results[int(
-                application['application_id'])] = ruleset.calc(application)
+            results[int(application['application_id'])] = dict(
+                ruleset.calc(application))
 
         return Response({
             'program': program,
@@ -79,16 +91,51 @@ class RulingsView(RulesetFinderMixin, APIView):
             'findings': results,
         })
 
+    @staticmethod
+    def rulings(ruleset, applications):
+        """
+        (application id, results) for each application, for `stream`
+
+        The first applicant is ruled on here, before any of the
+        response is sent, so a broken rule still fails the request.
+        """
+
+        rulings = []
+        started = False
+        for application in applications:
+            results = ruleset.calc(application)
+            if not started:
+                first = list(islice(results, 1))
+                started = bool(first)
+                results = chain(first, results)
+            rulings.append((int(application['application_id']), results))
+        return rulings
+
+    @staticmethod
+    def stream(program, entity, rulings):
+        """
+        Same JSON as `post`'s Response, in chunks as applicants are ruled on
+        """
+
+        yield b'{"program":%s,"entity":%s,"findings":{' % (
+            orjson.dumps(program), orjson.dumps(entity))
+        for (app_index, (application_id, results)) in enumerate(rulings):
+            yield b'%s%s:{' % (b',' if app_index else b'',
+                               orjson.dumps(str(application_id)))
+            for (index, (applicant_id, result)) in enumerate(results):
+                yield b'%s%s:%s' % (b',' if index else b'',
+                                    orjson.dumps(str(applicant_id)),
+                                    orjson.dumps(result))
+            yield b'}'
+        yield b'}}'
+
 
 class RulesetView(RulesetFinderMixin, APIView):
     def get(self, request, program, entity, format=None):
 
         ruleset = self.get_ruleset(program=program, entity=entity)
         data = RulesetSerializer(ruleset).data
-        data['sql'] = [
-            sqlparse.format(r.sql(), reindent=True, keyword_case='upper')
-            for r in ruleset.rule_set.all()
-        ]
+        data['sql'] = [rule.formatted_code for rule in ruleset.rules]
         return Response(data)
 
 
@@ -109,7 +156,7 @@ class RulesetSqlView(RulesetFinderMixin, APIView):
         ruleset = self.get_ruleset(program=program, entity=entity)
         return self.sql(
             request=request,
-            payload=ruleset.sample_input,
+            payload=fast_copy(ruleset.sample_input),
             program=program,
             entity=entity,
             format=format)